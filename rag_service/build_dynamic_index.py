@@ -5,91 +5,387 @@ when the glossary is updated through the admin interface.
 The glossary data is passed from the Firebase Function.
 """
 import os
+import sys
+from dataclasses import dataclass, field, fields
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.util import batch_to_device
+from transformers import PreTrainedTokenizerFast
 import faiss
 import pickle
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
 from typing import List, Dict, Any
 from datetime import datetime
 
 # Configuration
 INDEX_FILE = "data/glossari_index.faiss"
 METADATA_FILE = "data/glossari_metadata.pkl"
+METADATA_PARQUET_FILE = "data/glossari_metadata.parquet"
+VARIANTS_FILE = "data/variants_lookup.pkl"
 MODEL_NAME = "projecte-aina/ST-NLI-ca_paraphrase-multilingual-mpnet-base"
 
+# ONNX export of MODEL_NAME (see export_onnx_model.py). When present it is loaded
+# with ONNX Runtime instead of PyTorch.
+ONNX_MODEL_DIR = "models/onnx"
+ONNX_FILE_NAME = os.environ.get("AINA_ONNX_FILE", "onnx/model_O3.onnx")
+
+# Glossary fields received from the Firebase Function
+INPUT_COLUMNS = [
+    "id", "terme_recomanat", "variants_no_normatives", "context_d_us", "categoria", "ambit",
+    "notes_linguistiques", "font", "exemples_correctes", "exemples_incorrectes",
+]
+STRING_COLUMNS = ["terme_recomanat", "context_d_us", "categoria", "ambit", "notes_linguistiques", "font"]
+
+
+@dataclass(slots=True)
+class GlossEntry:
+    """One glossary entry as stored in the metadata file (row i = FAISS vector i)."""
+    id: str
+    terme_recomanat: str
+    variants_no_normatives: List[str] = field(default_factory=list)
+    context_d_us: str = ""
+    categoria: str = ""
+    ambit: str = ""
+    comentari: str = ""
+    font: str = ""
+    exemple_1: str = ""
+    exemple_2: str = ""
+    exemple_3: str = ""
+    exemple_incorrecte_1: str = ""
+    exemple_incorrecte_2: str = ""
+
+
+# Fields of each entry in the metadata file
+METADATA_COLUMNS = [f.name for f in fields(GlossEntry)]
+# Columnar layout of the metadata file; row i is FAISS vector i
+GLOSSARI_SCHEMA = pa.schema([
+    (column, pa.list_(pa.string()) if column == "variants_no_normatives" else pa.string())
+    for column in METADATA_COLUMNS
+])
+
+# Reduced-precision inference (FP16 on CUDA, BF16 on CPU) is reverted to FP32
+# if the cosine similarity of the sample embeddings drifts more than this
+PRECISION_DRIFT_TOLERANCE = 1e-3
+PRECISION_SAMPLE_TEXTS = [
+    "Les entitats que conformen el sector públic de la Generalitat.",
+    "quedar-me sense",
+    "vivenda",
+    "influenciar la política",
+]
+
+# Opt-in data-parallel encoding for large builds (AINA_PARALLEL_ENCODE=1); off by
+# default because of the OpenMP conflict on macOS
+PARALLEL_ENCODE_MIN_TEXTS = 1000
+PARALLEL_ENCODE_MAX_WORKERS = 4
+
+# HNSW graph parameters (M = neighbours per node, efConstruction = build-time beam width)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+
+
+def configure_faiss():
+    """
+    Log which SIMD kernels FAISS was loaded with and enable multi-threaded search.
+    faiss-cpu wheels pick the AVX2/AVX-512 build at import when the CPU supports it;
+    a GENERIC build means the dot-product scan runs without vectorized kernels.
+    """
+    compile_options = faiss.get_compile_options()
+    print(f"FAISS compile options: {compile_options}")
+    if "GENERIC" in compile_options or not any(opt in compile_options for opt in ("AVX2", "AVX512")):
+        print("WARNING: FAISS loaded without AVX2/AVX-512 kernels. Search will be slower.")
+
+    # On macOS OMP_NUM_THREADS=1 is kept (OpenMP conflict, see main.py)
+    if sys.platform != "darwin":
+        faiss.omp_set_num_threads(os.cpu_count() or 1)
+
+
+def encode_smart(model, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = False) -> np.ndarray:
+    """
+    Encode texts grouped by tokenized length so each batch pads to a similar size.
+    All texts are tokenized once in a single batched tokenizer call; each length-sorted
+    batch is then padded and run through the model's forward pass directly (instead of
+    SentenceTransformer.encode, which re-tokenizes and re-sorts by character length).
+    Embeddings are returned in the input order as a C-contiguous float32 array, ready for FAISS.
+    """
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    tokenizer = model.tokenizer
+    # Same preprocessing as SentenceTransformer.tokenize: stripped text, truncated to max_seq_length
+    encoded = tokenizer(
+        [str(t).strip() for t in texts],
+        truncation=True,
+        max_length=model.max_seq_length,
+        padding=False,
+    )
+    lengths = [len(ids) for ids in encoded["input_ids"]]
+    order = np.argsort(lengths, kind="stable")
+
+    # Tensors are cast to FP32 here: FAISS needs float32 and NumPy has no bfloat16.
+    # Normalization (if requested) happens in Torch before the copy to NumPy.
+    batches = []
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch_order = order[start:start + batch_size]
+            features = tokenizer.pad(
+                {key: [values[i] for i in batch_order] for key, values in encoded.items()},
+                return_tensors="pt",
+            )
+            features = batch_to_device(dict(features), model.device)
+            embeddings = model.forward(features)["sentence_embedding"]
+            if normalize_embeddings:
+                embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+            batches.append(embeddings.float().cpu().numpy())
+    embeddings = np.concatenate(batches)[np.argsort(order)]
+
+    if embeddings.dtype != np.float32 or not embeddings.flags.c_contiguous:
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    return embeddings
+
+
+def check_fast_tokenizer(model: SentenceTransformer):
+    """Warn if the model's tokenizer is the pure-Python one instead of the Rust (fast) tokenizer."""
+    if not isinstance(model.tokenizer, PreTrainedTokenizerFast):
+        print(f"WARNING: {type(model.tokenizer).__name__} is not a fast tokenizer. Tokenization will be slower.")
+
+
+def encode_parallel(model, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = False) -> np.ndarray:
+    """
+    Encode texts with a pool of CPU worker processes (SentenceTransformer multi-process pool).
+    PyTorch backend only: the model is pickled into the workers.
+    Returns embeddings in the input order as a C-contiguous float32 array.
+    """
+    cpu_count = os.cpu_count() or 1
+    workers = min(PARALLEL_ENCODE_MAX_WORKERS, cpu_count)
+    print(f"Encoding {len(texts)} texts with {workers} worker processes...")
+
+    # Each spawned worker would otherwise use every core; split them between workers.
+    # The children read the thread limits from the environment when they start.
+    # A lower existing limit (OMP_NUM_THREADS=1 on macOS) is kept.
+    threads_per_worker = max(1, cpu_count // workers)
+    thread_vars = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+    saved_env = {name: os.environ.get(name) for name in thread_vars}
+    for name, value in saved_env.items():
+        if value is None or not value.isdigit() or int(value) > threads_per_worker:
+            os.environ[name] = str(threads_per_worker)
+    try:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    try:
+        embeddings = model.encode_multi_process(
+            texts, pool, batch_size=batch_size, normalize_embeddings=normalize_embeddings
+        )
+    finally:
+        model.stop_multi_process_pool(pool)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def _load_onnx_model() -> SentenceTransformer:
+    import onnxruntime as ort
+
+    # ONNX Runtime uses its own thread pool, independent of OMP_NUM_THREADS
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = os.cpu_count() or 1
+
+    return SentenceTransformer(
+        ONNX_MODEL_DIR,
+        backend="onnx",
+        model_kwargs={
+            "file_name": ONNX_FILE_NAME,
+            "provider": "CPUExecutionProvider",
+            "session_options": session_options,
+        },
+    )
+
+
+def _cpu_has_native_bf16() -> bool:
+    """
+    True if the CPU has BF16 matmul instructions (AVX512-BF16 or AMX) usable through oneDNN.
+    Elsewhere BF16 is emulated and slower than FP32.
+    """
+    if not torch.backends.mkldnn.is_available():
+        return False
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu_flags = f.read()
+    except OSError:  # Not Linux (e.g. macOS)
+        return False
+    return "avx512_bf16" in cpu_flags or "amx_bf16" in cpu_flags
+
+
+def load_embedding_model() -> SentenceTransformer:
+    """
+    Load the embedding model.
+    Uses the ONNX Runtime export in ONNX_MODEL_DIR when available. Otherwise loads
+    the PyTorch model, running it in FP16 on CUDA, or in BF16 on CPUs with native BF16
+    support (FP32 on other CPUs); the reduced-precision model is validated against FP32
+    embeddings of a small sample set and reverted to FP32 if the cosine drift exceeds
+    the tolerance. Set AINA_EMBEDDING_FP32=1 to skip the conversion.
+    """
+    if os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_FILE_NAME)):
+        print(f"Loading ONNX model {ONNX_MODEL_DIR}/{ONNX_FILE_NAME}...")
+        model = _load_onnx_model()
+        check_fast_tokenizer(model)
+        return model
+
+    print(f"ONNX model not found in {ONNX_MODEL_DIR}, loading PyTorch model {MODEL_NAME}...")
+    model = SentenceTransformer(MODEL_NAME)
+    check_fast_tokenizer(model)
+    if os.environ.get("AINA_EMBEDDING_FP32") == "1":
+        return model
+
+    if model.device.type != "cuda" and not _cpu_has_native_bf16():
+        print("CPU without native BF16 (AVX512-BF16/AMX), embedding model running in fp32")
+        return model
+
+    reference = encode_smart(model, PRECISION_SAMPLE_TEXTS, normalize_embeddings=True)
+
+    if model.device.type == "cuda":
+        precision = "fp16"
+        model.half()
+    else:
+        precision = "bf16"
+        model[0].auto_model.to(torch.bfloat16)
+
+    reduced = encode_smart(model, PRECISION_SAMPLE_TEXTS, normalize_embeddings=True)
+    drift = float(np.max(1.0 - np.sum(reference * reduced, axis=1)))
+
+    if drift > PRECISION_DRIFT_TOLERANCE:
+        print(f"WARNING: {precision} cosine drift {drift:.2e} exceeds {PRECISION_DRIFT_TOLERANCE}, using fp32")
+        model.float()
+    else:
+        print(f"Embedding model running in {precision} (cosine drift {drift:.2e})")
+    return model
+
+
+def create_index(embeddings):
+    """
+    Create an HNSW index over L2-normalized embeddings.
+    Uses Inner Product metric (equivalent to Cosine since vectors are normalized),
+    giving sublinear search instead of the exhaustive scan of IndexFlatIP.
+    """
+    dimension = embeddings.shape[1]
+    index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.add(embeddings)
+    return index
+
+
+def clean_str(entry, key: str) -> str:
+    """Read a field as a stripped string ('' when missing), converting only non-strings."""
+    value = entry.get(key)
+    if isinstance(value, str):
+        return value.strip()
+    return "" if value is None else str(value).strip()
+
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else []
+
+
+def _prefixed(column: pd.Series) -> pd.Series:
+    """Prepend a separator space to non-empty values so optional text parts can be concatenated."""
+    return (" " + column).where(column != "", "")
+
+
+def write_index(index):
+    """
+    Write the FAISS index to a temporary file and atomically rename it over INDEX_FILE.
+    The running service memory-maps INDEX_FILE, so it must never be rewritten in place.
+    """
+    tmp_file = f"{INDEX_FILE}.tmp"
+    faiss.write_index(index, tmp_file)
+    os.replace(tmp_file, INDEX_FILE)
+
+
+def build_variants_lookup(glossari_data: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Build a lookup table mapping lemmatized variants to the index of their glossary entry.
+    This allows matching conjugated forms (e.g., "conformen") to their infinitive ("conformar").
+    """
+    lookup = {}
+
+    for idx, entry in enumerate(glossari_data or []):
+        for variant in entry.get('variants_no_normatives', []):
+            if variant and isinstance(variant, str):
+                lookup[variant.lower().strip()] = idx
+
+    print(f"Variants lookup built with {len(lookup)} entries")
+    return lookup
+
+
+def save_metadata(glossari: List[Dict[str, Any]]):
+    """
+    Save the glossary metadata and its variants lookup next to the FAISS index.
+    Metadata is written as Parquet (read by the service) and as the legacy pickle.
+    """
+    print(f"Saving metadata to {METADATA_FILE}...")
+    with open(METADATA_FILE, "wb") as f:
+        pickle.dump(glossari, f)
+
+    print(f"Saving metadata to {METADATA_PARQUET_FILE}...")
+    table = pa.Table.from_pylist(glossari, schema=GLOSSARI_SCHEMA)
+    pq.write_table(table, METADATA_PARQUET_FILE, compression="zstd")
+
+    print(f"Saving variants lookup to {VARIANTS_FILE}...")
+    with open(VARIANTS_FILE, "wb") as f:
+        pickle.dump(build_variants_lookup(glossari), f)
+
 
 def prepare_glossary_for_vectorization(glossary_data: List[Dict[str, Any]]):
     """
     Prepare glossary data for vectorization.
     Converts the input format to the internal metadata format and builds texts for embedding.
+    Cleaning and text assembly run column-wise on a DataFrame instead of per entry.
     """
-    glossari = []
-    texts_to_embed = []
-    
-    for entry in glossary_data:
-        terme_recomanat = str(entry.get('terme_recomanat', '')).strip()
-        
-        if not terme_recomanat:
-            continue
-        
-        # Handle variants - can be array or string
-        variants = entry.get('variants_no_normatives', [])
-        if isinstance(variants, str):
-            variants = [v.strip() for v in variants.split(',') if v.strip()]
-        
-        context = str(entry.get('context_d_us', '')).strip()
-        
-        # Build metadata object
-        metadata = {
-            "id": entry.get('id', ''),
-            "terme_recomanat": terme_recomanat,
-            "variants_no_normatives": variants,
-            "context_d_us": context,
-            "categoria": str(entry.get('categoria', '')).strip(),
-            "ambit": str(entry.get('ambit', '')).strip(),
-            "comentari": str(entry.get('notes_linguistiques', '')).strip(),
-            "font": str(entry.get('font', '')).strip(),
-            "exemple_1": "",
-            "exemple_2": "",
-            "exemple_3": "",
-            "exemple_incorrecte_1": "",
-            "exemple_incorrecte_2": "",
-        }
-        
-        # Handle examples - stored as arrays
-        exemples_correctes = entry.get('exemples_correctes', [])
-        if isinstance(exemples_correctes, list):
-            for i, ex in enumerate(exemples_correctes[:3]):
-                metadata[f"exemple_{i+1}"] = str(ex).strip()
-        
-        exemples_incorrectes = entry.get('exemples_incorrectes', [])
-        if isinstance(exemples_incorrectes, list):
-            for i, ex in enumerate(exemples_incorrectes[:2]):
-                metadata[f"exemple_incorrecte_{i+1}"] = str(ex).strip()
-        
-        glossari.append(metadata)
-        
-        # Build text for vectorization
-        # Strategy: Recommended term + Variants + Incorrect Examples + Context
-        # We include variants and incorrect examples so the vector representation 
-        # matches the "problem" (user text) we are searching for.
-        text_parts = [terme_recomanat]
-        
-        # Add variants (crucial for matching incorrect terms)
-        if variants:
-            text_parts.extend(variants)
-            
-        # Add incorrect examples (crucial for matching context)
-        if isinstance(exemples_incorrectes, list):
-            text_parts.extend([str(ex).strip() for ex in exemples_incorrectes if ex])
+    if not glossary_data:
+        return [], []
+
+    df = pd.DataFrame(glossary_data)
+    for column in INPUT_COLUMNS:
+        if column not in df:
+            df[column] = None
+
+    df[STRING_COLUMNS] = df[STRING_COLUMNS].fillna("").astype(str).apply(lambda col: col.str.strip())
+    df["id"] = df["id"].fillna("")
+
+    # Handle variants - can be array or string
+    df["variants_no_normatives"] = df["variants_no_normatives"].map(
+        lambda v: [x.strip() for x in v.split(",") if x.strip()] if isinstance(v, str) else _as_list(v)
+    )
+
+    # Handle examples - stored as arrays
+    exemples_correctes = df["exemples_correctes"].map(_as_list)
+    for i in range(3):
+        df[f"exemple_{i+1}"] = exemples_correctes.str[i].fillna("").astype(str).str.strip()
+
+    exemples_incorrectes = df["exemples_incorrectes"].map(_as_list)
+    for i in range(2):
+        df[f"exemple_incorrecte_{i+1}"] = exemples_incorrectes.str[i].fillna("").astype(str).str.strip()
+
+    # Build text for vectorization
+    # Strategy: Recommended term + Variants + Incorrect Examples + Context
+    # We include variants and incorrect examples so the vector representation 
+    # matches the "problem" (user text) we are searching for.
+    variants_text = df["variants_no_normatives"].str.join(" ").fillna("")
+    incorrectes_text = exemples_incorrectes.map(lambda v: " ".join(str(ex).strip() for ex in v if ex))
+    context = df["context_d_us"].where(df["context_d_us"] != "nan", "")
+    texts = df["terme_recomanat"] + _prefixed(variants_text) + _prefixed(incorrectes_text) + _prefixed(context)
+
+    valid = df["terme_recomanat"] != ""
+    df = df.rename(columns={"notes_linguistiques": "comentari"})
+    glossari = df.loc[valid, METADATA_COLUMNS].to_dict("records")
+    texts_to_embed = texts[valid].tolist()
 
-        # Add context
-        if context and context != 'nan':
-            text_parts.append(context)
-            
-        text_combinat = " ".join(text_parts)
-        
-        texts_to_embed.append(text_combinat)
-    
     return glossari, texts_to_embed
 
 
@@ -115,26 +411,34 @@ def build_index_from_data(glossary_data: List[Dict[str, Any]]) -> Dict[str, Any]
             }
             
         print(f"Loading model {MODEL_NAME}...")
-        model = SentenceTransformer(MODEL_NAME)
-        
-        print(f"Generating embeddings for {len(texts_to_embed)} entries...")
-        embeddings = model.encode(texts_to_embed, batch_size=32, show_progress_bar=True)
+        model = load_embedding_model()
         
-        # Normalize vectors for cosine similarity
-        faiss.normalize_L2(embeddings)
+        # Identical texts (e.g. reimported entries) are encoded once and scattered back
+        unique_texts, inverse = np.unique(np.array(texts_to_embed, dtype=object), return_inverse=True)
+        dedup_ratio = 1 - len(unique_texts) / len(texts_to_embed)
+        print(f"Generating embeddings for {len(unique_texts)} unique texts out of {len(texts_to_embed)} entries "
+              f"({dedup_ratio:.1%} duplicates)...")
+        # Normalized vectors for cosine similarity
+        parallel = os.environ.get("AINA_PARALLEL_ENCODE") == "1" and len(unique_texts) > PARALLEL_ENCODE_MIN_TEXTS
+        if parallel and model.backend != "torch":
+            # The pool pickles the model into spawned workers; ONNX Runtime sessions can't be
+            # pickled (and ONNX Runtime already runs on all cores, see _load_onnx_model)
+            print(f"AINA_PARALLEL_ENCODE ignored: the {model.backend} backend can't be sent to worker processes")
+            parallel = False
+        if parallel:
+            unique_embeddings = encode_parallel(model, unique_texts.tolist(), batch_size=32, normalize_embeddings=True)
+        else:
+            unique_embeddings = encode_smart(model, unique_texts.tolist(), batch_size=32, normalize_embeddings=True)
+        embeddings = unique_embeddings[inverse]
         
         print("Creating FAISS index...")
         dimension = embeddings.shape[1]
-        # IndexFlatIP uses Inner Product (equivalent to Cosine if vectors are normalized)
-        index = faiss.IndexFlatIP(dimension)
-        index.add(embeddings)
+        index = create_index(embeddings)
         
         print(f"Saving index to {INDEX_FILE}...")
-        faiss.write_index(index, INDEX_FILE)
+        write_index(index)
         
-        print(f"Saving metadata to {METADATA_FILE}...")
-        with open(METADATA_FILE, "wb") as f:
-            pickle.dump(glossari, f)
+        save_metadata(glossari)
         
         # Calculate processing time and index size
         end_time = datetime.now()
@@ -158,7 +462,7 @@ def build_index_from_data(glossary_data: List[Dict[str, Any]]) -> Dict[str, Any]
             "vectorizedEntries": len(glossari),
             "embeddingModel": MODEL_NAME,
             "vectorDimensions": dimension,
-            "indexType": "FAISS FlatIP",
+            "indexType": "FAISS HNSWFlat",
             "processingTime": f"{processing_time:.1f}s",
             "indexSize": size_str,
             "error": None
@@ -1,14 +1,20 @@
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-import faiss
-import pickle
 import os
-import numpy as np
+from dataclasses import asdict
+from build_dynamic_index import (
+    GlossEntry,
+    clean_str,
+    configure_faiss,
+    create_index,
+    encode_smart,
+    load_embedding_model,
+    save_metadata,
+    write_index,
+)
 
 # Configuració
 DATA_FILE = "data/termes.csv"
 INDEX_FILE = "data/glossari_index.faiss"
-METADATA_FILE = "data/glossari_metadata.pkl"
 # MODEL_NAME = "projecte-aina/roberta-base-ca-v2" 
 # Changed to a multilingual model optimized for sentence similarity that supports Catalan
 # MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2" 
@@ -18,6 +24,7 @@ METADATA_FILE = "data/glossari_metadata.pkl"
 MODEL_NAME = "projecte-aina/ST-NLI-ca_paraphrase-multilingual-mpnet-base"
 
 def build_index():
+    configure_faiss()
     print(f"Carregant dades de {DATA_FILE}...")
     if not os.path.exists(DATA_FILE):
         print(f"ERROR: No s'ha trobat el fitxer {DATA_FILE}")
@@ -37,30 +44,30 @@ def build_index():
     print("Processant entrades...")
     for _, row in df.iterrows():
         # Extreure camps (gestió d'errors bàsica per valors nuls)
-        terme_recomanat = str(row.get('Terme recomanat', '')).strip()
-        terme_incorrecte = str(row.get('Terme no normatiu o inadequat', '')).strip()
-        context = str(row.get("context d'ús", '')).strip()
-        id_terme = str(row.get('ID', '')).strip()
+        terme_recomanat = clean_str(row, 'Terme recomanat')
+        terme_incorrecte = clean_str(row, 'Terme no normatiu o inadequat')
+        context = clean_str(row, "context d'ús")
+        id_terme = clean_str(row, 'ID')
         
         if not terme_recomanat:
             continue
 
         # Crear objecte de metadades amb totes les columnes del CSV
-        entrada = {
-            "id": id_terme,
-            "terme_recomanat": terme_recomanat,
-            "variants_no_normatives": [v.strip() for v in terme_incorrecte.split(',')] if terme_incorrecte else [],
-            "context_d_us": context,
-            "categoria": str(row.get('Categoria', '')).strip(),
-            "ambit": str(row.get('Àmbit', '')).strip(),
-            "comentari": str(row.get('Comentari/notes lingüístiques', '')).strip(),
-            "font": str(row.get('Font', '')).strip(),
-            "exemple_1": str(row.get('Exemple 1', '')).strip(),
-            "exemple_2": str(row.get('Exemple 2', '')).strip(),
-            "exemple_3": str(row.get('Exemple 3', '')).strip(),
-            "exemple_incorrecte_1": str(row.get('Exemple incorrecte 1', '')).strip(),
-            "exemple_incorrecte_2": str(row.get('Exemple incorrecte 2', '')).strip(),
-        }
+        entrada = GlossEntry(
+            id=id_terme,
+            terme_recomanat=terme_recomanat,
+            variants_no_normatives=[v.strip() for v in terme_incorrecte.split(',')] if terme_incorrecte else [],
+            context_d_us=context,
+            categoria=clean_str(row, 'Categoria'),
+            ambit=clean_str(row, 'Àmbit'),
+            comentari=clean_str(row, 'Comentari/notes lingüístiques'),
+            font=clean_str(row, 'Font'),
+            exemple_1=clean_str(row, 'Exemple 1'),
+            exemple_2=clean_str(row, 'Exemple 2'),
+            exemple_3=clean_str(row, 'Exemple 3'),
+            exemple_incorrecte_1=clean_str(row, 'Exemple incorrecte 1'),
+            exemple_incorrecte_2=clean_str(row, 'Exemple incorrecte 2'),
+        )
         glossari.append(entrada)
 
         # Construir text per vectoritzar
@@ -74,26 +81,21 @@ def build_index():
         texts_to_embed.append(text_combinat)
 
     print(f"Carregant model {MODEL_NAME}...")
-    model = SentenceTransformer(MODEL_NAME)
+    model = load_embedding_model()
 
     print(f"Generant embeddings per a {len(texts_to_embed)} entrades...")
-    embeddings = model.encode(texts_to_embed, batch_size=32, show_progress_bar=True)
-
-    # Normalitzar vectors per a distància cosinus (opcional però recomanat per a FAISS inner product)
-    faiss.normalize_L2(embeddings)
+    # Vectors normalitzats per a distància cosinus (necessari per a FAISS inner product)
+    embeddings = encode_smart(model, texts_to_embed, batch_size=32, normalize_embeddings=True)
 
     print("Creant índex FAISS...")
-    dimension = embeddings.shape[1]
-    # IndexFlatIP fa servir Inner Product (equivalent a Cosinus si els vectors estan normalitzats)
-    index = faiss.IndexFlatIP(dimension) 
-    index.add(embeddings)
+    # Índex HNSW amb Inner Product (equivalent a Cosinus si els vectors estan normalitzats)
+    index = create_index(embeddings)
 
     print(f"Guardant índex a {INDEX_FILE}...")
-    faiss.write_index(index, INDEX_FILE)
+    write_index(index)
 
-    print(f"Guardant metadades a {METADATA_FILE}...")
-    with open(METADATA_FILE, "wb") as f:
-        pickle.dump(glossari, f)
+    # Metadades i taula de variants (data/variants_lookup.pkl)
+    save_metadata([asdict(entrada) for entrada in glossari])
 
     print("Procés completat correctament.")
 
@@ -0,0 +1,34 @@
+"""
+Export the embedding model to ONNX for the ONNX Runtime backend.
+Writes a SentenceTransformer directory to ONNX_MODEL_DIR with:
+  - onnx/model.onnx                        (plain export)
+  - onnx/model_O3.onnx                     (graph optimizations, loaded by default)
+  - onnx/model_qint8_avx512_vnni.onnx      (dynamic INT8 quantization, opt-in via AINA_ONNX_FILE)
+Run once before building the index (the Dockerfile does it at build time).
+"""
+from sentence_transformers import (
+    SentenceTransformer,
+    export_dynamic_quantized_onnx_model,
+    export_optimized_onnx_model,
+)
+
+from build_dynamic_index import MODEL_NAME, ONNX_MODEL_DIR
+
+
+def export_onnx_model():
+    print(f"Exportant {MODEL_NAME} a ONNX...")
+    model = SentenceTransformer(MODEL_NAME, backend="onnx")
+    model.save_pretrained(ONNX_MODEL_DIR)
+
+    # O3: fusions de grafs sense canviar la precisió (O4 només és per a GPU en fp16)
+    print("Optimitzant el graf ONNX (O3)...")
+    export_optimized_onnx_model(model, "O3", ONNX_MODEL_DIR)
+
+    print("Quantitzant el model a INT8 (dinàmic)...")
+    export_dynamic_quantized_onnx_model(model, "avx512_vnni", ONNX_MODEL_DIR)
+
+    print(f"Model ONNX guardat a {ONNX_MODEL_DIR}")
+
+
+if __name__ == "__main__":
+    export_onnx_model()
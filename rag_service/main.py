@@ -1,64 +1,267 @@
 import os
-# Fix per a error de conflicte OpenMP en macOS (evita crash/empty reply)
-os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
-# Fix addicional per a error "pthread_mutex_init failed" en macOS
-os.environ['OMP_NUM_THREADS'] = '1'
+import re
+import sys
+import time
+if sys.platform == 'darwin':
+    # Fix per a error de conflicte OpenMP en macOS (evita crash/empty reply)
+    os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+    # Fix addicional per a error "pthread_mutex_init failed" en macOS
+    os.environ['OMP_NUM_THREADS'] = '1'
 
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
 import faiss
 import pickle
+import pyarrow as pa
+import pyarrow.parquet as pq
 import numpy as np
-from typing import List, Optional, Dict, Any
+from collections import OrderedDict
+from typing import List, Optional, Dict
 import spacy
+from numba import njit, types
+from numba.typed import Dict as NumbaDict
+try:
+    # Opcional (només x86_64): cerca multi-patró amb DFA per a les expressions multiparaula
+    import hyperscan
+except ImportError:
+    hyperscan = None
+from build_dynamic_index import (
+    GLOSSARI_SCHEMA,
+    VARIANTS_FILE,
+    build_variants_lookup,
+    configure_faiss,
+    encode_smart,
+    load_embedding_model,
+)
 
 app = FastAPI(title="Aina RAG Service", version="1.0")
 
 # Configuració
 INDEX_FILE = "data/glossari_index.faiss"
 METADATA_FILE = "data/glossari_metadata.pkl"
+METADATA_PARQUET_FILE = "data/glossari_metadata.parquet"
 # MODEL_NAME = "projecte-aina/roberta-base-ca-v2"
 # MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2" 
 MODEL_NAME = "projecte-aina/ST-NLI-ca_paraphrase-multilingual-mpnet-base"
+# Amplada mínima del feix de cerca HNSW (efSearch)
+HNSW_EF_SEARCH_MIN = 32
+# Nombre màxim de vectors de candidats guardats a la cache LRU
+EMBEDDING_CACHE_SIZE = 50_000
+
+# Columnes de glossari_table mantingudes com a arrays NumPy per a /detect-candidates
+HOT_COLUMNS = ["id", "terme_recomanat", "categoria"]
+# Mida del batch de textos per a nlp_model.pipe a /detect-candidates-batch
+NLP_BATCH_SIZE = 16
+# Expressions multiparaula: mida de n-grama de més llarg a més curt (4 -> 2 tokens)
+MWE_NGRAM_SIZES = np.array([4, 3, 2], dtype=np.int64)
+NGRAM_HASH_BASE = 1_000_003
 
 # Variables globals per mantenir els models en memòria
 model = None
 index = None
-glossari = None
+glossari_table = None  # Metadades del glossari en format columnar (pyarrow), fila i = vector FAISS i
+glossari_hot = None  # Columnes que es llegeixen a cada detecció (id, terme_recomanat, categoria)
 nlp_model = None  # spaCy model for lemmatization
-variants_lookup = None  # Hash table: lemma -> glossary entry
+variants_lookup = None  # Hash table: lemma -> fila de glossari_table
+mwe_variants = None  # Variants multiparaula, indexades pels valors de mwe_hash_map
+mwe_hash_map = None  # Hash del n-grama (int64) -> índex a mwe_variants
+mwe_database = None  # Base de dades Hyperscan amb mwe_variants (si hyperscan està instal·lat)
+embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()  # candidat -> vector normalitzat
 
 
-def build_variants_lookup(glossari_data: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+@njit(cache=True)
+def ngram_hash(token_hashes, start, size):
+    """Polynomial hash of token_hashes[start:start + size] (int64, wraps on overflow)."""
+    h = 0
+    for j in range(start, start + size):
+        h = h * NGRAM_HASH_BASE + token_hashes[j]
+    return h
+
+
+@njit(cache=True)
+def scan_ngrams(token_hashes, ngram_sizes, variant_hash_map):
     """
-    Build a lookup table mapping lemmatized variants to glossary entries.
-    This allows matching conjugated forms (e.g., "conformen") to their infinitive ("conformar").
+    Multi-word scan: for each n-gram size (longest first) and position, look up
+    the n-gram hash. Returns rows of (position, ngram_size, variant index) for every
+    hash hit, in scan order; the caller discards collisions and overlaps.
     """
-    lookup = {}
-    
-    if not glossari_data:
+    n_tokens = token_hashes.shape[0]
+    matches = np.empty((n_tokens * ngram_sizes.shape[0], 3), dtype=np.int64)
+    n_matches = 0
+
+    for ngram_size in ngram_sizes:
+        for i in range(n_tokens - ngram_size + 1):
+            h = ngram_hash(token_hashes, i, ngram_size)
+            if h in variant_hash_map:
+                matches[n_matches, 0] = i
+                matches[n_matches, 1] = ngram_size
+                matches[n_matches, 2] = variant_hash_map[h]
+                n_matches += 1
+
+    return matches[:n_matches]
+
+
+def build_mwe_hash_map(lookup: Dict[str, int]):
+    """
+    Index the multi-word variants of the lookup by the hash of their words,
+    computed the same way scan_ngrams hashes spaCy token n-grams.
+    """
+    variants = []
+    hash_map = NumbaDict.empty(key_type=types.int64, value_type=types.int64)
+    min_size, max_size = int(MWE_NGRAM_SIZES.min()), int(MWE_NGRAM_SIZES.max())
+
+    for variant in lookup:
+        words = variant.split(" ")
+        if min_size <= len(words) <= max_size:
+            word_hashes = np.array([hash(w) for w in words], dtype=np.int64)
+            hash_map[ngram_hash(word_hashes, 0, len(words))] = len(variants)
+            variants.append(variant)
+
+    return variants, hash_map
+
+
+def build_mwe_database(variants: List[str]):
+    """
+    Compile the multi-word variants into a Hyperscan database of literal patterns,
+    with the variant index as pattern id. Returns None if hyperscan is not installed.
+    """
+    if hyperscan is None or not variants:
+        return None
+
+    database = hyperscan.Database()
+    database.compile(
+        expressions=[re.escape(v).encode("utf-8") for v in variants],
+        ids=list(range(len(variants))),
+        elements=len(variants),
+        flags=[hyperscan.HS_FLAG_SOM_LEFTMOST] * len(variants),
+    )
+    return database
+
+
+def scan_mwe_hyperscan(doc) -> List[tuple]:
+    """
+    Multi-word scan in one linear pass with Hyperscan.
+    Scans the lowercased tokens joined by single spaces (the same string the n-gram
+    comparison builds) and keeps matches that start and end on token boundaries.
+    Returns (position, ngram_size, variant index) tuples in the same order as
+    scan_ngrams (longest first, then by position); the caller resolves overlaps.
+    """
+    token_starts, token_ends = {}, {}
+    parts = []
+    offset = 0
+    for i, token in enumerate(doc):
+        encoded = token.text.lower().encode("utf-8")
+        token_starts[offset] = i
+        offset += len(encoded)
+        token_ends[offset] = i
+        offset += 1  # separador
+        parts.append(encoded)
+
+    found = []
+
+    def on_match(variant_idx, start, end, flags, context):
+        first, last = token_starts.get(start), token_ends.get(end)
+        if first is not None and last is not None:
+            found.append((first, last - first + 1, variant_idx))
+
+    mwe_database.scan(b" ".join(parts), match_event_handler=on_match)
+    return sorted(found, key=lambda m: (-m[1], m[0]))
+
+
+def set_variants_lookup(lookup: Dict[str, int]):
+    """Install a variants lookup together with the multi-word matchers derived from it."""
+    global variants_lookup, mwe_variants, mwe_hash_map, mwe_database
+    variants_lookup = lookup
+    mwe_variants, mwe_hash_map = build_mwe_hash_map(lookup)
+    mwe_database = build_mwe_database(mwe_variants)
+
+
+def metadata_exists() -> bool:
+    return os.path.exists(METADATA_PARQUET_FILE) or os.path.exists(METADATA_FILE)
+
+
+def _mtime(path: str) -> float:
+    return os.path.getmtime(path) if os.path.exists(path) else 0.0
+
+
+def load_metadata():
+    """
+    Load the glossary metadata as (pyarrow Table, hot columns).
+    Reads the Parquet file written by the index build; falls back to the legacy
+    pickle when there is no Parquet file or it is older than the pickle.
+    Full entries stay in the Arrow table (outside the Python heap) and are only
+    materialized for the rows a request returns; the hot columns are NumPy arrays.
+    """
+    if os.path.exists(METADATA_PARQUET_FILE) and _mtime(METADATA_PARQUET_FILE) >= _mtime(METADATA_FILE):
+        table = pq.read_table(METADATA_PARQUET_FILE)
+    else:
+        with open(METADATA_FILE, "rb") as f:
+            table = pa.Table.from_pylist(pickle.load(f), schema=GLOSSARI_SCHEMA)
+
+    hot = {column: np.array(table.column(column).to_pylist(), dtype=object) for column in HOT_COLUMNS}
+    return table, hot
+
+
+def build_variants_lookup_from_table(table) -> Dict[str, int]:
+    return build_variants_lookup(table.select(["variants_no_normatives"]).to_pylist())
+
+
+def load_variants_lookup(table) -> Dict[str, int]:
+    """
+    Load the variants lookup persisted next to the metadata by the index build.
+    Rebuilds it from the glossary if the file is missing or older than the metadata.
+    """
+    metadata_mtime = max(_mtime(METADATA_PARQUET_FILE), _mtime(METADATA_FILE))
+    if os.path.exists(VARIANTS_FILE) and _mtime(VARIANTS_FILE) >= metadata_mtime:
+        with open(VARIANTS_FILE, "rb") as f:
+            lookup = pickle.load(f)
+        print(f"Variants lookup loaded with {len(lookup)} entries")
         return lookup
-    
-    for entry in glossari_data:
-        terme_recomanat = entry.get('terme_recomanat', '')
-        variants = entry.get('variants_no_normatives', [])
-        categoria = entry.get('categoria', '')
-        
-        # Map each variant to the glossary entry
-        for variant in variants:
-            if variant and isinstance(variant, str):
-                variant_lower = variant.lower().strip()
-                lookup[variant_lower] = {
-                    'id': entry.get('id', ''),
-                    'terme_recomanat': terme_recomanat,
-                    'categoria': categoria,
-                    'context': entry.get('context_d_us', ''),
-                    'variant_original': variant
-                }
-    
-    print(f"Variants lookup built with {len(lookup)} entries")
-    return lookup
+    return build_variants_lookup_from_table(table)
+
+
+def read_index():
+    """
+    Read the FAISS index, memory-mapping its vectors when this FAISS build supports it.
+    IO_FLAG_MMAP_IFC (faiss-cpu pinned in requirements.txt) maps the flat code arrays,
+    i.e. the vectors of IndexFlatIP and the storage of IndexHNSWFlat, so the OS pages
+    them in on demand.
+    Plain IO_FLAG_MMAP only maps IVF inverted lists, so without IO_FLAG_MMAP_IFC the
+    index is read fully into RAM.
+    """
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if mmap_flag is None:
+        print("AVÍS: Aquesta versió de FAISS no pot mapejar índexs Flat/HNSW a memòria. Llegint l'índex sencer...")
+        return faiss.read_index(INDEX_FILE)
+    try:
+        return faiss.read_index(INDEX_FILE, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+    except Exception as e:
+        print(f"AVÍS: No s'ha pogut mapejar l'índex a memòria ({e}). Llegint-lo sencer...")
+        return faiss.read_index(INDEX_FILE)
+
+
+def encode_candidates(candidates: List[str]) -> np.ndarray:
+    """
+    Encode search candidates as normalized float32 vectors, reusing cached vectors.
+    Only cache misses go through the model; the least recently used vectors are evicted.
+    """
+    if not candidates:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    misses = list(dict.fromkeys(c for c in candidates if c not in embedding_cache))
+    print(f"Vectoritzant {len(misses)} candidats ({len(candidates) - len(misses)} a la cache)...")
+    if misses:
+        vectors = encode_smart(model, misses, normalize_embeddings=True)  # Normalitzats per a cerca cosinus
+        for candidate, vector in zip(misses, vectors):
+            embedding_cache[candidate] = vector.copy()
+
+    for candidate in candidates:
+        embedding_cache.move_to_end(candidate)
+    vectors = np.stack([embedding_cache[c] for c in candidates])
+
+    while len(embedding_cache) > EMBEDDING_CACHE_SIZE:
+        embedding_cache.popitem(last=False)
+    return vectors
 
 
 class DetectCandidatesRequest(BaseModel):
@@ -84,6 +287,17 @@ class DetectCandidatesResult(BaseModel):
     nlp_model_used: str
     error: Optional[str] = None
 
+class DetectCandidatesBatchRequest(BaseModel):
+    texts: List[str]
+    context_window: Optional[int] = 3
+
+
+class DetectCandidatesBatchResult(BaseModel):
+    success: bool
+    results: List[List[DetectedCandidate]]
+    nlp_model_used: str
+    error: Optional[str] = None
+
 class SearchRequest(BaseModel):
     candidates: List[str]
     k: Optional[int] = 5
@@ -109,16 +323,70 @@ class SearchResult(BaseModel):
     original: str
     matches: List[MatchResult]
 
+
+def build_match_results(idxs: List[int], scores: List[float]) -> List[MatchResult]:
+    """
+    Gather the matched rows from glossari_table in a single take() and build their
+    results from the column lists (every column is present, see GLOSSARI_SCHEMA).
+    """
+    columns = glossari_table.take(pa.array(idxs, type=pa.int64())).to_pydict()
+    return [
+        MatchResult(
+            id=columns['id'][r],
+            terme_recomanat=columns['terme_recomanat'][r],
+            similitud=score,
+            context=columns['context_d_us'][r],
+            variants=columns['variants_no_normatives'][r],
+            categoria=columns['categoria'][r],
+            ambit=columns['ambit'][r],
+            comentari=columns['comentari'][r],
+            font=columns['font'][r],
+            exemple_1=columns['exemple_1'][r],
+            exemple_2=columns['exemple_2'][r],
+            exemple_3=columns['exemple_3'][r],
+            exemple_incorrecte_1=columns['exemple_incorrecte_1'][r],
+            exemple_incorrecte_2=columns['exemple_incorrecte_2'][r],
+        )
+        for r, score in enumerate(scores)
+    ]
+
+def warmup_models():
+    """
+    Run one dummy pass through each loaded component so that lazy initialisation
+    (kernel compilation, tokenizer loading, index paging, numba JIT) does not land
+    on the first requests.
+    """
+    try:
+        start = time.perf_counter()
+        encode_smart(model, ["escalfament"], normalize_embeddings=True)
+        print(f"Escalfament del model d'embeddings: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        if nlp_model is not None:
+            start = time.perf_counter()
+            doc = nlp_model("paraula de prova")
+            if mwe_hash_map is not None:
+                # Compila també l'escaneig de n-grames (numba)
+                detect_candidates_in_doc(doc, 3)
+            print(f"Escalfament del model spaCy: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        if index is not None:
+            start = time.perf_counter()
+            index.search(np.zeros((1, index.d), dtype=np.float32), 1)
+            print(f"Escalfament de l'índex FAISS: {(time.perf_counter() - start) * 1000:.0f} ms")
+    except Exception as e:
+        print(f"AVÍS: L'escalfament ha fallat, el servei continua sense escalfar: {e}")
+
 @app.on_event("startup")
 async def load_models():
-    global model, index, glossari, nlp_model, variants_lookup
+    global model, index, glossari_table, glossari_hot, nlp_model, variants_lookup
     
     print("Inicialitzant servei RAG...")
+    configure_faiss()
     
     # 1. Carregar Model d'embeddings
     print(f"Carregant model {MODEL_NAME}...")
     try:
-        model = SentenceTransformer(MODEL_NAME)
+        model = load_embedding_model()
     except Exception as e:
         print(f"Error carregant el model: {e}")
         raise RuntimeError("No s'ha pogut carregar el model d'embeddings")
@@ -142,25 +410,28 @@ async def load_models():
     # 3. Carregar Índex FAISS (opcional al primer inici)
     if os.path.exists(INDEX_FILE):
         print("Carregant índex FAISS...")
-        index = faiss.read_index(INDEX_FILE)
+        index = read_index()
     else:
         print(f"AVÍS: No s'ha trobat l'índex a {INDEX_FILE}. El servei s'iniciarà sense índex.")
         print("Utilitzeu l'endpoint /vectorize per crear l'índex.")
         index = None
 
     # 4. Carregar Metadades (opcional al primer inici)
-    if os.path.exists(METADATA_FILE):
+    if metadata_exists():
         print("Carregant metadades...")
-        with open(METADATA_FILE, "rb") as f:
-            glossari = pickle.load(f)
-        # Build variants lookup table for lemma-based detection
-        variants_lookup = build_variants_lookup(glossari)
+        glossari_table, glossari_hot = load_metadata()
+        # Variants lookup table for lemma-based detection
+        set_variants_lookup(load_variants_lookup(glossari_table))
     else:
-        print(f"AVÍS: No s'han trobat les metadades a {METADATA_FILE}.")
-        glossari = None
+        print(f"AVÍS: No s'han trobat les metadades a {METADATA_PARQUET_FILE} ni {METADATA_FILE}.")
+        glossari_table = None
+        glossari_hot = None
         variants_lookup = None
         
-    if index is not None and glossari is not None:
+    # 5. Escalfament perquè la latència estable comenci des de la primera petició
+    warmup_models()
+
+    if index is not None and glossari_table is not None:
         print("Servei llest amb índex carregat!")
     else:
         print("Servei iniciat sense índex. Esperant vectorització...")
@@ -170,73 +441,69 @@ async def search(request: SearchRequest):
     if not model:
         raise HTTPException(status_code=503, detail="Model no carregat. El servei no està inicialitzat correctament.")
     
-    if not index or not glossari:
+    if not index or glossari_table is None:
         raise HTTPException(
             status_code=503, 
             detail="Índex no disponible. Utilitzeu l'endpoint /vectorize per crear l'índex primer."
         )
 
     results = []
-    print(f"Vectoritzant {len(request.candidates)} candidats...")
-    vectors = model.encode(request.candidates, convert_to_numpy=True)
-    
-    # Assegurar tipus float32 per a FAISS (evita errors de tipus)
-    vectors = vectors.astype(np.float32)
-    
-    print("Normalitzant vectors...")
-    faiss.normalize_L2(vectors) # Normalitzar per a cerca cosinus
 
-    # Cerca en batch
-    print("Executant cerca FAISS...")
-    distances, indices = index.search(vectors, request.k)
-    print("Cerca finalitzada.")
+    # Candidats que coincideixen exactament amb una variant: no cal vectoritzar ni cercar
+    exact_matches = {}
+    if variants_lookup:
+        for i, candidate in enumerate(request.candidates):
+            glossari_idx = variants_lookup.get(candidate.lower().strip())
+            if glossari_idx is not None:
+                exact_matches[i] = glossari_idx
+    fuzzy_positions = [i for i in range(len(request.candidates)) if i not in exact_matches]
+    print(f"{len(exact_matches)} candidats amb coincidència exacta, {len(fuzzy_positions)} per cercar")
+
+    # Una fila de k resultats per candidat; `keep` marca els que es retornen
+    width = max(request.k, 1)
+    all_idxs = np.full((len(request.candidates), width), -1, dtype=np.int64)
+    all_scores = np.zeros((len(request.candidates), width), dtype=np.float32)
+    keep = np.zeros((len(request.candidates), width), dtype=np.bool_)
+
+    if exact_matches:
+        exact_positions = np.fromiter(exact_matches.keys(), dtype=np.int64, count=len(exact_matches))
+        all_idxs[exact_positions, 0] = np.fromiter(exact_matches.values(), dtype=np.int64, count=len(exact_matches))
+        all_scores[exact_positions, 0] = 1.0
+        keep[exact_positions, 0] = True
+
+    if fuzzy_positions:
+        vectors = encode_candidates([request.candidates[i] for i in fuzzy_positions])
+
+        # Cerca en batch
+        print("Executant cerca FAISS...")
+        if hasattr(index, "hnsw"):
+            # Índexs antics (IndexFlatIP) no tenen graf HNSW i fan cerca exhaustiva
+            index.hnsw.efSearch = max(HNSW_EF_SEARCH_MIN, request.k * 4)
+        distances, indices = index.search(vectors, request.k)
+        print("Cerca finalitzada.")
+
+        fuzzy_rows = np.array(fuzzy_positions, dtype=np.int64)
+        all_idxs[fuzzy_rows, :request.k] = indices
+        all_scores[fuzzy_rows, :request.k] = distances  # Inner product = similitud cosinus (vectors normalitzats)
+        keep[fuzzy_rows, :request.k] = (indices >= 0) & (distances >= request.threshold)  # idx < 0: sense resultat
+
+    # Totes les files de glossari en un sol take(), repartides després per candidat
+    all_matches = build_match_results(all_idxs[keep].tolist(), all_scores[keep].tolist())
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
 
     for i, candidate in enumerate(request.candidates):
-        matches = []
-        for j in range(request.k):
-            idx = indices[i][j]
-            score = distances[i][j] # Inner product = cosinus similarity (si normalitzat)
-            
-            if idx < 0: continue # No match found by FAISS
-            
-            if score >= request.threshold:
-                entry = glossari[idx]
-                matches.append(MatchResult(
-                    id=entry.get('id', ''),
-                    terme_recomanat=entry['terme_recomanat'],
-                    similitud=float(score),
-                    context=entry.get('context_d_us', ''),
-                    variants=entry.get('variants_no_normatives', []),
-                    categoria=entry.get('categoria', ''),
-                    ambit=entry.get('ambit', ''),
-                    comentari=entry.get('comentari', ''),
-                    font=entry.get('font', ''),
-                    exemple_1=entry.get('exemple_1', ''),
-                    exemple_2=entry.get('exemple_2', ''),
-                    exemple_3=entry.get('exemple_3', ''),
-                    exemple_incorrecte_1=entry.get('exemple_incorrecte_1', ''),
-                    exemple_incorrecte_2=entry.get('exemple_incorrecte_2', ''),
-                ))
-        
+        matches = all_matches[ends[i - 1] if i else 0:ends[i]]
         results.append(SearchResult(original=candidate, matches=matches))
-    # # Print all candidates and their matched terme_recomanat
-        for result in results:
-            print(f"\nCandidate: {candidate}")
-            print(f"\nCandidate: {result.original} - Matches found: {len(result.matches)}")
-            for match in result.matches:
-                print(f"  - {match.terme_recomanat} (similitud: {match.similitud:.3f})")
+
+    # Print all candidates and their matched terme_recomanat
+    for result in results:
+        print(f"\nCandidate: {result.original} - Matches found: {len(result.matches)}")
+        for match in result.matches:
+            print(f"  - {match.terme_recomanat} (similitud: {match.similitud:.3f})")
     return results
 
 
-@app.post("/detect-candidates", response_model=DetectCandidatesResult)
-async def detect_candidates(request: DetectCandidatesRequest):
-    """
-    Detect candidate terms in text using NLP lemmatization.
-    Uses spaCy's Catalan model to lemmatize words and match against glossary variants.
-    This properly handles verb conjugations (e.g., "conformen" -> "conformar").
-    """
-    global nlp_model, variants_lookup
-    
+def check_nlp_ready():
     if not nlp_model:
         raise HTTPException(
             status_code=503,
@@ -248,109 +515,131 @@ async def detect_candidates(request: DetectCandidatesRequest):
             status_code=503,
             detail="Lookup de variants no disponible. Vectoritzeu el glossari primer."
         )
-    
-    text = request.text
-    context_window = request.context_window
+
+
+def detect_candidates_in_doc(doc, context_window: int) -> List[DetectedCandidate]:
+    """
+    Find glossary variants in a spaCy doc: multi-word expressions first, then
+    single tokens by lemma or exact form. Returns candidates sorted by position.
+    """
+    candidates = []
+    detected = np.zeros(len(doc), dtype=np.bool_)
+
+    # First pass: check for multi-word expressions (up to 4 words)
+    # Hyperscan scans the text in one pass; otherwise the n-gram scan runs
+    # JIT-compiled over integer token hashes. Both return hits longest first;
+    # tokens are only claimed once a hit is verified against the variant text.
+    if mwe_database is not None:
+        mwe_matches = scan_mwe_hyperscan(doc)
+    else:
+        token_hashes = np.array([hash(t.text.lower()) for t in doc], dtype=np.int64)
+        mwe_matches = scan_ngrams(token_hashes, MWE_NGRAM_SIZES, mwe_hash_map).tolist()
+
+    for i, ngram_size, variant_idx in mwe_matches:
+        # Skip if any position already detected
+        if detected[i:i + ngram_size].any():
+            continue
+
+        # Build ngram from tokens
+        tokens = doc[i:i + ngram_size]
+        ngram_text = " ".join([t.text for t in tokens])
+        ngram_lower = ngram_text.lower()
+
+        # Discard hash collisions
+        if ngram_lower != mwe_variants[variant_idx]:
+            continue
+
+        detected[i:i + ngram_size] = True
+        glossari_idx = variants_lookup[ngram_lower]
+
+        # Build context
+        start_ctx = max(0, i - context_window)
+        end_ctx = min(len(doc), i + ngram_size + context_window)
+        context = " ".join([t.text for t in doc[start_ctx:end_ctx]])
+
+        candidates.append(DetectedCandidate(
+            term=ngram_text,
+            lemma=ngram_lower,
+            position=i,
+            context=context,
+            pos_tag="MWE",  # Multi-word expression
+            glossary_id=glossari_hot['id'][glossari_idx],
+            terme_recomanat=glossari_hot['terme_recomanat'][glossari_idx],
+            categoria=glossari_hot['categoria'][glossari_idx],
+            source="nlp"
+        ))
+
+    # Second pass: check individual tokens using lemmatization
+    for i, token in enumerate(doc):
+        if detected[i]:
+            continue
+
+        # Skip punctuation and spaces
+        if token.is_punct or token.is_space:
+            continue
+
+        lemma = token.lemma_.lower()
+        token_lower = token.text.lower()
+
+        # Check lemma first, then exact token
+        match_idx = None
+        matched_form = None
+
+        if lemma in variants_lookup:
+            match_idx = variants_lookup[lemma]
+            matched_form = lemma
+        elif token_lower in variants_lookup:
+            match_idx = variants_lookup[token_lower]
+            matched_form = token_lower
+
+        if match_idx is not None:
+            # Optional: verify POS tag matches category
+            categoria = glossari_hot['categoria'][match_idx].lower()
+            pos = token.pos_
+
+            # Skip if category is 'verb' but word is not used as verb
+            # (allows for flexible matching while avoiding false positives)
+            if categoria == 'verb' and pos not in ['VERB', 'AUX']:
+                # Still include but mark with lower confidence
+                pass
+
+            detected[i] = True
+
+            # Build context window
+            start_ctx = max(0, i - context_window)
+            end_ctx = min(len(doc), i + 1 + context_window)
+            context = " ".join([t.text for t in doc[start_ctx:end_ctx]])
+
+            candidates.append(DetectedCandidate(
+                term=token.text,
+                lemma=matched_form,
+                position=i,
+                context=context,
+                pos_tag=pos,
+                glossary_id=glossari_hot['id'][match_idx],
+                terme_recomanat=glossari_hot['terme_recomanat'][match_idx],
+                categoria=glossari_hot['categoria'][match_idx],
+                source="nlp"
+            ))
+
+    # Sort by position
+    candidates.sort(key=lambda x: x.position)
+    return candidates
+
+
+@app.post("/detect-candidates", response_model=DetectCandidatesResult)
+async def detect_candidates(request: DetectCandidatesRequest):
+    """
+    Detect candidate terms in text using NLP lemmatization.
+    Uses spaCy's Catalan model to lemmatize words and match against glossary variants.
+    This properly handles verb conjugations (e.g., "conformen" -> "conformar").
+    """
+    check_nlp_ready()
     
     try:
         # Process text with spaCy
-        doc = nlp_model(text)
-        words = text.split()
-        candidates = []
-        detected_positions = set()
-        
-        # First pass: check for multi-word expressions (up to 4 words)
-        for ngram_size in range(4, 1, -1):
-            for i in range(len(doc) - ngram_size + 1):
-                # Skip if any position already detected
-                if any(j in detected_positions for j in range(i, i + ngram_size)):
-                    continue
-                
-                # Build ngram from tokens
-                tokens = doc[i:i + ngram_size]
-                ngram_text = " ".join([t.text for t in tokens])
-                ngram_lower = ngram_text.lower()
-                
-                # Check exact match for multi-word expressions
-                if ngram_lower in variants_lookup:
-                    entry = variants_lookup[ngram_lower]
-                    
-                    # Mark positions as detected
-                    for j in range(i, i + ngram_size):
-                        detected_positions.add(j)
-                    
-                    # Build context
-                    start_ctx = max(0, i - context_window)
-                    end_ctx = min(len(doc), i + ngram_size + context_window)
-                    context = " ".join([t.text for t in doc[start_ctx:end_ctx]])
-                    
-                    candidates.append(DetectedCandidate(
-                        term=ngram_text,
-                        lemma=ngram_lower,
-                        position=i,
-                        context=context,
-                        pos_tag="MWE",  # Multi-word expression
-                        glossary_id=entry['id'],
-                        terme_recomanat=entry['terme_recomanat'],
-                        categoria=entry['categoria'],
-                        source="nlp"
-                    ))
-        
-        # Second pass: check individual tokens using lemmatization
-        for i, token in enumerate(doc):
-            if i in detected_positions:
-                continue
-            
-            # Skip punctuation and spaces
-            if token.is_punct or token.is_space:
-                continue
-            
-            lemma = token.lemma_.lower()
-            token_lower = token.text.lower()
-            
-            # Check lemma first, then exact token
-            match_entry = None
-            matched_form = None
-            
-            if lemma in variants_lookup:
-                match_entry = variants_lookup[lemma]
-                matched_form = lemma
-            elif token_lower in variants_lookup:
-                match_entry = variants_lookup[token_lower]
-                matched_form = token_lower
-            
-            if match_entry:
-                # Optional: verify POS tag matches category
-                categoria = match_entry['categoria'].lower()
-                pos = token.pos_
-                
-                # Skip if category is 'verb' but word is not used as verb
-                # (allows for flexible matching while avoiding false positives)
-                if categoria == 'verb' and pos not in ['VERB', 'AUX']:
-                    # Still include but mark with lower confidence
-                    pass
-                
-                detected_positions.add(i)
-                
-                # Build context window
-                start_ctx = max(0, i - context_window)
-                end_ctx = min(len(doc), i + 1 + context_window)
-                context = " ".join([t.text for t in doc[start_ctx:end_ctx]])
-                
-                candidates.append(DetectedCandidate(
-                    term=token.text,
-                    lemma=matched_form,
-                    position=i,
-                    context=context,
-                    pos_tag=pos,
-                    glossary_id=match_entry['id'],
-                    terme_recomanat=match_entry['terme_recomanat'],
-                    categoria=match_entry['categoria'],
-                    source="nlp"
-                ))
-        
-        # Sort by position
-        candidates.sort(key=lambda x: x.position)
+        doc = nlp_model(request.text)
+        candidates = detect_candidates_in_doc(doc, request.context_window)
         
         model_name = nlp_model.meta.get('name', 'unknown')
         print(f"NLP detection completed: {len(candidates)} candidates found using {model_name}")
@@ -372,21 +661,53 @@ async def detect_candidates(request: DetectCandidatesRequest):
         )
 
 
+@app.post("/detect-candidates-batch", response_model=DetectCandidatesBatchResult)
+async def detect_candidates_batch(request: DetectCandidatesBatchRequest):
+    """
+    Detect candidate terms in several texts at once.
+    Texts go through nlp_model.pipe so spaCy batches the transformer forward pass.
+    Returns one candidate list per input text, in the same order.
+    """
+    check_nlp_ready()
+    
+    try:
+        docs = nlp_model.pipe(request.texts, batch_size=NLP_BATCH_SIZE)
+        results = [detect_candidates_in_doc(doc, request.context_window) for doc in docs]
+        
+        model_name = nlp_model.meta.get('name', 'unknown')
+        total = sum(len(candidates) for candidates in results)
+        print(f"NLP batch detection completed: {total} candidates in {len(results)} texts using {model_name}")
+        
+        return DetectCandidatesBatchResult(
+            success=True,
+            results=results,
+            nlp_model_used=model_name,
+            error=None
+        )
+        
+    except Exception as e:
+        print(f"Error in NLP batch detection: {e}")
+        return DetectCandidatesBatchResult(
+            success=False,
+            results=[],
+            nlp_model_used="error",
+            error=str(e)
+        )
+
+
 @app.post("/reload-variants")
 async def reload_variants():
     """
     Reload the variants lookup table from current glossari.
     Call this after vectorization to update the lookup table.
     """
-    global variants_lookup, glossari
-    
-    if not glossari:
+    if glossari_table is None:
         raise HTTPException(
             status_code=503,
             detail="No glossari loaded. Run vectorization first."
         )
     
-    variants_lookup = build_variants_lookup(glossari)
+    set_variants_lookup(build_variants_lookup_from_table(glossari_table))
     return {
         "success": True,
         "variants_count": len(variants_lookup)
@@ -428,7 +749,7 @@ async def vectorize(request: VectorizeRequest):
     Trigger re-vectorization of the glossary.
     Receives glossary data from Firebase Function and rebuilds the FAISS index.
     """
-    global index, glossari, variants_lookup
+    global index, glossari_table, glossari_hot
     
     from build_dynamic_index import build_index_from_data
     
@@ -459,14 +780,13 @@ async def vectorize(request: VectorizeRequest):
         
         # Reload the index and metadata
         print("Reloading index and metadata...")
-        index = faiss.read_index(INDEX_FILE)
-        with open(METADATA_FILE, "rb") as f:
-            glossari = pickle.load(f)
+        index = read_index()
+        glossari_table, glossari_hot = load_metadata()
         
-        # Rebuild variants lookup for NLP detection
-        variants_lookup = build_variants_lookup(glossari)
+        # Reload variants lookup for NLP detection
+        set_variants_lookup(load_variants_lookup(glossari_table))
         
-        print(f"Index reloaded with {len(glossari)} entries, {len(variants_lookup)} variants")
+        print(f"Index reloaded with {glossari_table.num_rows} entries, {len(variants_lookup)} variants")
         
         return VectorizeResult(
             success=True,
@@ -494,8 +814,8 @@ async def health():
         "status": "ok",
         "model_loaded": model is not None,
         "index_loaded": index is not None,
-        "glossary_entries": len(glossari) if glossari else 0,
-        "ready_for_search": model is not None and index is not None and glossari is not None,
+        "glossary_entries": glossari_table.num_rows if glossari_table is not None else 0,
+        "ready_for_search": model is not None and index is not None and glossari_table is not None,
         "nlp_model_loaded": nlp_model is not None,
         "nlp_model_name": nlp_model_name,
         "variants_count": len(variants_lookup) if variants_lookup else 0,
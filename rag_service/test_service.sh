@@ -13,3 +13,12 @@ curl -X POST http://127.0.0.1:8000/search \
     "threshold": 0.52
   }'
 echo -e "\n"
+
+echo "Testing Batch NLP Detection Endpoint..."
+curl -X POST http://127.0.0.1:8000/detect-candidates-batch \
+  -H "Content-Type: application/json" \
+  -d '{
+    "texts": ["Les entitats que conformen el sector públic.", "Cal influenciar la política."],
+    "context_window": 3
+  }'
+echo -e "\n"
@@ -1,6 +1,8 @@
 from google.cloud import aiplatform
 from google.cloud import storage # <--- NOVA IMPORTACIÓ
-from google.api_core.exceptions import NotFound, Forbidden
+from google.api_core.exceptions import Forbidden
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # --- CONFIGURACIÓ ---
 # PROJECT_ID = "aina-474214"   # <--- POSA EL TEU ID AQUÍ
@@ -19,6 +21,14 @@ HF_MODEL_ID = "BSC-LT/salamandra-7b-instruct"
 # Utilitzem una versió més recent i estable (Desembre 2025) per corregir errors de versions anteriors
 VLLM_DOCKER_URI = "us-docker.pkg.dev/vertex-ai/vertex-vision-model-garden-dockers/pytorch-vllm-serve:20251211_0916_RC01_stable"
 
+# aiplatform.init ja cridat en aquest procés (per a processos que criden get_or_deploy_* diverses vegades)
+_INITIALIZED = False
+
+@lru_cache(maxsize=None)
+def _storage_client(project_id):
+    """Client de Cloud Storage per projecte, creat un sol cop (credencials i sessió HTTP reutilitzades)."""
+    return storage.Client(project=project_id)
+
 def garantizar_bucket(bucket_uri, project_id, location):
     """
     Comprova si el bucket existeix. Si no, el crea.
@@ -26,39 +36,62 @@ def garantizar_bucket(bucket_uri, project_id, location):
     # Netejar el prefix 'gs://' si hi és, la llibreria storage vol només el nom
     bucket_name = bucket_uri.replace("gs://", "")
     
-    storage_client = storage.Client(project=project_id)
+    storage_client = _storage_client(project_id)
     
+    # exists() només demana el nom del bucket, sense descarregar-ne totes les metadades
     try:
-        bucket = storage_client.get_bucket(bucket_name)
+        exists = storage_client.bucket(bucket_name).exists()
+    except Forbidden:
+        print(f"❌ Error: El bucket existeix però no tens permisos per accedir-hi.")
+        raise
+    
+    if exists:
         print(f"✅ Bucket existent trobat: {bucket_uri}")
-    except NotFound:
+    else:
         print(f"⚠️ El bucket {bucket_uri} no existeix. Creant-lo a {location}...")
         try:
-            bucket = storage_client.create_bucket(bucket_name, location=location)
+            storage_client.create_bucket(bucket_name, location=location)
             print(f"✅ Bucket creat correctament: {bucket_uri}")
         except Exception as e:
             print(f"❌ Error crític creant el bucket: {e}")
             print("NOTA: Els noms de bucket han de ser únics a tot el món.")
             raise e
-    except Forbidden:
-        print(f"❌ Error: El bucket existeix però no tens permisos per accedir-hi.")
-        raise
     
     return bucket_uri
 
-def get_or_deploy_salamandra():
-    # 0. GARANTIR BUCKET (Pas previ)
-    garantizar_bucket(STAGING_BUCKET, PROJECT_ID, REGION)
+@lru_cache(maxsize=None)
+def _garantizar_bucket_un_cop(bucket_uri, project_id, location):
+    """garantizar_bucket només la primera vegada per procés (si falla, es torna a provar)."""
+    return garantizar_bucket(bucket_uri, project_id, location)
 
-    # Ara ja podem inicialitzar Vertex AI amb seguretat
-    aiplatform.init(project=PROJECT_ID, location=REGION, staging_bucket=STAGING_BUCKET)
+def get_or_deploy_salamandra():
+    # aiplatform.init només desa la configuració (no fa cap crida a l'API)
+    global _INITIALIZED
+    if not _INITIALIZED:
+        aiplatform.init(project=PROJECT_ID, location=REGION, staging_bucket=STAGING_BUCKET)
+        _INITIALIZED = True
 
-    # 1. COMPROVAR SI L'ENDPOINT JA EXISTEIX (Està corrent?)
+    # 0. GARANTIR BUCKET i buscar endpoint i model alhora: són crides de xarxa independents
     print(f"🔍 Buscant endpoint existent: '{ENDPOINT_DISPLAY_NAME}'...")
-    existing_endpoints = aiplatform.Endpoint.list(
-        filter=f'display_name="{ENDPOINT_DISPLAY_NAME}"'
-    )
+    print(f"🔍 Buscant model al registre: '{MODEL_DISPLAY_NAME}'...")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        bucket_future = executor.submit(_garantizar_bucket_un_cop, STAGING_BUCKET, PROJECT_ID, REGION)
+        endpoints_future = executor.submit(
+            aiplatform.Endpoint.list,
+            filter=f'display_name="{ENDPOINT_DISPLAY_NAME}"',
+            order_by="create_time desc",
+        )
+        models_future = executor.submit(
+            aiplatform.Model.list,
+            filter=f'display_name="{MODEL_DISPLAY_NAME}"',
+            order_by="create_time desc",
+        )
+        bucket_future.result()
+        # Només cal el més recent de cada (ordenats per data de creació)
+        existing_endpoints = endpoints_future.result()[:1]
+        existing_models = models_future.result()[:1]
 
+    # 1. COMPROVAR SI L'ENDPOINT JA EXISTEIX (Està corrent?)
     if existing_endpoints:
         endpoint = existing_endpoints[0]
         print(f"✅ Endpoint trobat: {endpoint.resource_name}")
@@ -68,11 +101,6 @@ def get_or_deploy_salamandra():
     print("❌ No s'ha trobat cap endpoint actiu.")
 
     # 2. COMPROVAR SI EL MODEL JA ESTÀ AL REGISTRE
-    print(f"🔍 Buscant model al registre: '{MODEL_DISPLAY_NAME}'...")
-    existing_models = aiplatform.Model.list(
-        filter=f'display_name="{MODEL_DISPLAY_NAME}"'
-    )
-
     if existing_models:
         model = existing_models[0]
         print(f"✅ Model trobat al registre: {model.resource_name}")
@@ -96,6 +124,8 @@ def get_or_deploy_salamandra():
                 "--gpu-memory-utilization=0.90", # CRÍTICO: Vertex necesita un margen de VRAM
                 "--max-model-len=8192",         # RECOMENDADO: Limita el contexto para no saturar la L4
                 "--trust-remote-code",          # Necesario para algunos modelos del BSC
+                "--enable-prefix-caching",      # Reutiliza la KV cache de prefijos repetidos (system prompt)
+                "--enable-chunked-prefill",     # Intercala el prefill con la decodificación
                 "--disable-log-stats"           # Opcional: Reduce el ruido en los logs de Google Cloud
             ],
             serving_container_ports=[8000],
@@ -1,7 +1,10 @@
 from google.cloud import aiplatform
 from google.cloud import storage
-from google.api_core.exceptions import NotFound, Forbidden
+from google.api_core.exceptions import Forbidden
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import argparse
+import os
 
 # --- CONFIGURACIÓ ---
 PROJECT_ID = "aina-demostradors"
@@ -12,16 +15,37 @@ STAGING_BUCKET = f"gs://{PROJECT_ID}-vertex-staging"
 BASE_ENDPOINT_NAME = "alia-40b-endpoint"
 BASE_MODEL_NAME = "alia-40b-instruct"
 HF_MODEL_ID = "BSC-LT/ALIA-40b-instruct"
+# Checkpoint quantitzat (AWQ/GPTQ int4) d'ALIA-40b-instruct, p. ex. generat amb AutoAWQ i
+# publicat a Hugging Face. Es pot passar també amb --model-id.
+QUANTIZED_HF_MODEL_ID = os.environ.get("ALIA_QUANTIZED_MODEL_ID")
 
 # Imatge Docker de Google per a vLLM
 VLLM_DOCKER_URI = "us-docker.pkg.dev/vertex-ai/vertex-vision-model-garden-dockers/pytorch-vllm-serve:20251211_0916_RC01_stable"
 
-def get_config(context_target):
+# Amb pesos int4 (~4x menys VRAM que bf16) calen la meitat de GPUs L4
+QUANTIZED_HARDWARE = {
+    "8k": {"machine_type": "g2-standard-24", "accelerator_count": 2},   # 2x L4 (48GB VRAM total)
+    "16k": {"machine_type": "g2-standard-48", "accelerator_count": 4},  # 4x L4 (96GB VRAM total)
+    "32k": {"machine_type": "g2-standard-48", "accelerator_count": 4},  # 4x L4 (96GB VRAM total)
+}
+
+def get_config(context_target, quantization=None):
     """
     Defineix la configuració de hardware i paràmetres segons el context desitjat.
     Per a contextos grans (16k, 32k) amb un model de 40B, necessitem més VRAM 
     per a la KV cache, per tant passem de 4 a 8 GPUs L4.
+    Amb un model quantitzat (awq/gptq) els pesos ocupen ~4x menys i n'hi ha prou
+    amb la meitat de GPUs (vegeu QUANTIZED_HARDWARE).
     """
+    config = _get_bf16_config(context_target)
+    if quantization:
+        hardware = QUANTIZED_HARDWARE[context_target]
+        config.update(hardware)
+        config["tensor_parallel_size"] = hardware["accelerator_count"]
+        config["suffix"] = f"{config['suffix']}-{quantization}"
+    return config
+
+def _get_bf16_config(context_target):
     if context_target == "8k":
         return {
             "max_model_len": 8192,
@@ -49,34 +73,58 @@ def get_config(context_target):
     else:
         raise ValueError(f"Context target '{context_target}' no suportat. Opcions: 8k, 16k, 32k")
 
+# aiplatform.init ja cridat en aquest procés (per a processos que criden get_or_deploy_* diverses vegades)
+_INITIALIZED = False
+
+@lru_cache(maxsize=None)
+def _storage_client(project_id):
+    """Client de Cloud Storage per projecte, creat un sol cop (credencials i sessió HTTP reutilitzades)."""
+    return storage.Client(project=project_id)
+
 def garantizar_bucket(bucket_uri, project_id, location):
     """
     Comprova si el bucket existeix. Si no, el crea.
     """
     bucket_name = bucket_uri.replace("gs://", "")
     
-    storage_client = storage.Client(project=project_id)
+    storage_client = _storage_client(project_id)
     
+    # exists() només demana el nom del bucket, sense descarregar-ne totes les metadades
     try:
-        bucket = storage_client.get_bucket(bucket_name)
+        exists = storage_client.bucket(bucket_name).exists()
+    except Forbidden:
+        print(f"❌ Error: El bucket existeix però no tens permisos per accedir-hi.")
+        raise
+    
+    if exists:
         print(f"✅ Bucket existent trobat: {bucket_uri}")
-    except NotFound:
+    else:
         print(f"⚠️ El bucket {bucket_uri} no existeix. Creant-lo a {location}...")
         try:
-            bucket = storage_client.create_bucket(bucket_name, location=location)
+            storage_client.create_bucket(bucket_name, location=location)
             print(f"✅ Bucket creat correctament: {bucket_uri}")
         except Exception as e:
             print(f"❌ Error crític creant el bucket: {e}")
             print("NOTA: Els noms de bucket han de ser únics a tot el món.")
             raise e
-    except Forbidden:
-        print(f"❌ Error: El bucket existeix però no tens permisos per accedir-hi.")
-        raise
     
     return bucket_uri
 
-def get_or_deploy_alia(context_target="8k"):
-    config = get_config(context_target)
+@lru_cache(maxsize=None)
+def _garantizar_bucket_un_cop(bucket_uri, project_id, location):
+    """garantizar_bucket només la primera vegada per procés (si falla, es torna a provar)."""
+    return garantizar_bucket(bucket_uri, project_id, location)
+
+def get_or_deploy_alia(context_target="8k", quantization=None, model_id=None):
+    config = get_config(context_target, quantization)
+    if quantization:
+        model_id = model_id or QUANTIZED_HF_MODEL_ID
+        if not model_id:
+            raise ValueError(
+                f"Cal un checkpoint {quantization} d'ALIA-40b: --model-id o ALIA_QUANTIZED_MODEL_ID"
+            )
+    else:
+        model_id = model_id or HF_MODEL_ID
     
     endpoint_display_name = f"{BASE_ENDPOINT_NAME}-{config['suffix']}"
     model_display_name = f"{BASE_MODEL_NAME}-{config['suffix']}"
@@ -84,19 +132,35 @@ def get_or_deploy_alia(context_target="8k"):
     print(f"⚙️  Configurant desplegament per context: {context_target}")
     print(f"   - Max Model Len: {config['max_model_len']}")
     print(f"   - Machine Type: {config['machine_type']} ({config['accelerator_count']} GPUs)")
+    print(f"   - Model: {model_id} ({quantization or 'bf16'})")
     
-    # 0. GARANTIR BUCKET (Pas previ)
-    garantizar_bucket(STAGING_BUCKET, PROJECT_ID, REGION)
-
-    # Ara ja podem inicialitzar Vertex AI amb seguretat
-    aiplatform.init(project=PROJECT_ID, location=REGION, staging_bucket=STAGING_BUCKET)
+    # aiplatform.init només desa la configuració (no fa cap crida a l'API)
+    global _INITIALIZED
+    if not _INITIALIZED:
+        aiplatform.init(project=PROJECT_ID, location=REGION, staging_bucket=STAGING_BUCKET)
+        _INITIALIZED = True
 
-    # 1. COMPROVAR SI L'ENDPOINT JA EXISTEIX (Està corrent?)
+    # 0. GARANTIR BUCKET i buscar endpoint i model alhora: són crides de xarxa independents
     print(f"🔍 Buscant endpoint existent: '{endpoint_display_name}'...")
-    existing_endpoints = aiplatform.Endpoint.list(
-        filter=f'display_name="{endpoint_display_name}"'
-    )
+    print(f"🔍 Buscant model al registre: '{model_display_name}'...")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        bucket_future = executor.submit(_garantizar_bucket_un_cop, STAGING_BUCKET, PROJECT_ID, REGION)
+        endpoints_future = executor.submit(
+            aiplatform.Endpoint.list,
+            filter=f'display_name="{endpoint_display_name}"',
+            order_by="create_time desc",
+        )
+        models_future = executor.submit(
+            aiplatform.Model.list,
+            filter=f'display_name="{model_display_name}"',
+            order_by="create_time desc",
+        )
+        bucket_future.result()
+        # Només cal el més recent de cada (ordenats per data de creació)
+        existing_endpoints = endpoints_future.result()[:1]
+        existing_models = models_future.result()[:1]
 
+    # 1. COMPROVAR SI L'ENDPOINT JA EXISTEIX (Està corrent?)
     endpoint = None
     if existing_endpoints:
         endpoint = existing_endpoints[0]
@@ -113,11 +177,6 @@ def get_or_deploy_alia(context_target="8k"):
         print("❌ No s'ha trobat cap endpoint actiu.")
 
     # 2. COMPROVAR SI EL MODEL JA ESTÀ AL REGISTRE
-    print(f"🔍 Buscant model al registre: '{model_display_name}'...")
-    existing_models = aiplatform.Model.list(
-        filter=f'display_name="{model_display_name}"'
-    )
-
     if existing_models:
         model = existing_models[0]
         print(f"✅ Model trobat al registre: {model.resource_name}")
@@ -129,12 +188,17 @@ def get_or_deploy_alia(context_target="8k"):
             serving_container_image_uri=VLLM_DOCKER_URI,
             serving_container_command=["python", "-m", "vllm.entrypoints.api_server"],
             serving_container_args=[
-                f"--model={HF_MODEL_ID}",
-                "--dtype=bfloat16",             
+                f"--model={model_id}",
+                # Els kernels AWQ/GPTQ de vLLM treballen en float16
+                "--dtype=float16" if quantization else "--dtype=bfloat16",
+                *([f"--quantization={quantization}"] if quantization else []),
                 f"--tensor-parallel-size={config['tensor_parallel_size']}",
                 "--gpu-memory-utilization=0.90", 
                 f"--max-model-len={config['max_model_len']}",         
                 "--trust-remote-code",          
+                "--enable-prefix-caching",      # Reutilitza la KV cache dels prefixos repetits (system prompt)
+                "--enable-chunked-prefill",     # Intercala el prefill amb la descodificació
+                "--kv-cache-dtype=fp8",         # L4 suporta fp8: KV cache a la meitat de memòria
                 "--disable-log-stats"           
             ],
             serving_container_ports=[8000],
@@ -172,11 +236,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Desplegar ALIA-40b amb diferents finestres de context.")
     parser.add_argument("context", nargs="?", default="16k", choices=["8k", "16k", "32k"], 
                         help="Mida del context (8k, 16k, 32k). Per defecte: 8k")
+    parser.add_argument("--quantization", choices=["awq", "gptq"],
+                        default=os.environ.get("ALIA_QUANTIZATION"),
+                        help="Desplegar un checkpoint quantitzat int4 amb la meitat de GPUs. Per defecte: bf16")
+    parser.add_argument("--model-id", default=None,
+                        help="Model de Hugging Face a desplegar (per defecte HF_MODEL_ID o ALIA_QUANTIZED_MODEL_ID)")
     
     args = parser.parse_args()
 
     try:
-        endpoint = get_or_deploy_alia(args.context)
+        endpoint = get_or_deploy_alia(args.context, args.quantization, args.model_id)
 
         # --- PROVA DE TRADUCCIÓ ---
         print(f"\n🧪 Provant el model ALIA ({args.context}) amb una pregunta en català...")
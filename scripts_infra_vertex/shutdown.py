@@ -12,7 +12,8 @@ def shutdown_salamandra():
 
     # 1. Buscar el endpoint activo
     endpoints = aiplatform.Endpoint.list(
-        filter=f'display_name="{ENDPOINT_DISPLAY_NAME}"'
+        filter=f'display_name="{ENDPOINT_DISPLAY_NAME}"',
+        order_by="create_time desc",
     )
 
     if not endpoints:
@@ -23,13 +24,10 @@ def shutdown_salamandra():
     for endpoint in endpoints:
         print(f"⚠️ Encontrado Endpoint activo: {endpoint.resource_name}")
         
-        # Paso A: Undeploy (Esto es lo que DETIENE la facturación de la GPU)
-        print("   ⏳ Retirando modelos (Undeploying)... esto puede tardar unos minutos.")
-        endpoint.undeploy_all()
-        
-        # Paso B: Borrar el recurso vacío
-        print("   🗑️ Borrando el objeto Endpoint...")
-        endpoint.delete()
+        # force=True retira los modelos (esto es lo que DETIENE la facturación de la GPU)
+        # y borra el Endpoint en una sola operación
+        print("   ⏳ Retirando modelos y borrando el Endpoint... esto puede tardar unos minutos.")
+        endpoint.delete(force=True, sync=True)
         
         print("✅ Endpoint eliminado correctamente. Facturación detenida.")
 
@@ -1,20 +1,25 @@
 from google.cloud import aiplatform
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import argparse
+import os
 
 # --- CONFIGURACIÓ ---
 PROJECT_ID = "aina-demostradors"
 REGION = "europe-west4"
 BASE_ENDPOINT_NAME = "alia-40b-endpoint"
 
-def shutdown_alia(context_target="8k"):
+def shutdown_alia(context_target="8k", quantization=None):
     """
-    Atura i elimina l'endpoint d'ALIA-40b per a un context específic.
+    Atura i elimina l'endpoint d'ALIA-40b per a un context específic
+    (i quantització, si es va desplegar amb lifecycle_big.py --quantization).
     """
     if context_target not in ["8k", "16k", "32k"]:
         print(f"❌ Context target '{context_target}' no vàlid. Opcions: 8k, 16k, 32k")
         return
     
-    endpoint_display_name = f"{BASE_ENDPOINT_NAME}-{context_target}"
+    suffix = f"{context_target}-{quantization}" if quantization else context_target
+    endpoint_display_name = f"{BASE_ENDPOINT_NAME}-{suffix}"
     
     print(f"🔌 Iniciant protocol d'apagament per a: {endpoint_display_name}...")
     
@@ -22,7 +27,8 @@ def shutdown_alia(context_target="8k"):
 
     # 1. Buscar l'endpoint actiu
     endpoints = aiplatform.Endpoint.list(
-        filter=f'display_name="{endpoint_display_name}"'
+        filter=f'display_name="{endpoint_display_name}"',
+        order_by="create_time desc",
     )
 
     if not endpoints:
@@ -33,21 +39,35 @@ def shutdown_alia(context_target="8k"):
     for endpoint in endpoints:
         print(f"⚠️ Trobat Endpoint actiu: {endpoint.resource_name}")
         
-        # Pas A: Undeploy (Això és el que DETÉ la facturació de la GPU)
-        print("   ⏳ Retirant models (Undeploying)... això pot trigar uns minuts.")
-        endpoint.undeploy_all()
-        
-        # Pas B: Borrar el recurs buit
-        print("   🗑️ Esborrant l'objecte Endpoint...")
-        endpoint.delete()
+        # force=True retira els models (això és el que DETÉ la facturació de la GPU)
+        # i esborra l'Endpoint en una sola operació
+        print("   ⏳ Retirant models i esborrant l'Endpoint... això pot trigar uns minuts.")
+        endpoint.delete(force=True, sync=True)
         
         print("✅ Endpoint eliminat correctament. Facturació aturada.")
 
+def shutdown_all(contexts=("8k", "16k", "32k"), quantization=None):
+    """
+    Atura els endpoints de diversos contextos alhora. Cada apagament és una espera
+    de xarxa (operació de llarga durada de Vertex), així que n'hi ha prou amb fils.
+    Com a màxim 3 en paral·lel per no topar amb la quota de l'API.
+    """
+    contexts = list(dict.fromkeys(contexts))  # Sense duplicats, en ordre
+    with ThreadPoolExecutor(max_workers=min(len(contexts), 3)) as executor:
+        list(executor.map(partial(shutdown_alia, quantization=quantization), contexts))
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Aturar i eliminar endpoint d'ALIA-40b.")
-    parser.add_argument("context", nargs="?", default="16k", choices=["8k", "16k", "32k"], 
-                        help="Mida del context de l'endpoint a aturar (8k, 16k, 32k). Per defecte: 8k")
+    parser = argparse.ArgumentParser(description="Aturar i eliminar endpoints d'ALIA-40b.")
+    # Sense 'choices': argparse no valida bé el valor per defecte d'un nargs="*"
+    parser.add_argument("contexts", nargs="*", default=["16k"], metavar="{8k,16k,32k}", 
+                        help="Mides del context dels endpoints a aturar (8k, 16k, 32k), una o més. Per defecte: 16k")
+    parser.add_argument("--quantization", choices=["awq", "gptq"],
+                        default=os.environ.get("ALIA_QUANTIZATION"),
+                        help="Aturar els endpoints desplegats amb aquesta quantització")
     
     args = parser.parse_args()
+    invalid = [c for c in args.contexts if c not in ["8k", "16k", "32k"]]
+    if invalid:
+        parser.error(f"Context target no vàlid: {', '.join(invalid)}. Opcions: 8k, 16k, 32k")
     
-    shutdown_alia(args.context)
+    shutdown_all(args.contexts, args.quantization)